@@ -1,12 +1,19 @@
-import base64
-import csv
+import binascii
+import json
+import multiprocessing
 import os
+import queue
 import re
+import threading
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Any, List, Tuple
+from typing import Any, Callable, List, Optional, Tuple
 
 import psycopg2
+import pybase64
+from psycopg2 import sql
 from dotenv import load_dotenv
 from openpyxl import load_workbook
 
@@ -34,94 +41,435 @@ class PostgreSQLConnection:
 
 # ================= Data Processor =================
 
+_TABLE_RE = re.compile(
+    r"(?:FROM|JOIN)\s+([a-zA-Z0-9_.\"]+)",
+    flags=re.IGNORECASE
+)
+
+# psycopg2 type OIDs used for per-column dispatch
+_OID_BYTEA = 17
+_OID_TEXT = {18, 19, 25, 1042, 1043}
+
+# bool/int/float/numeric/date/time(stamp): their text form can never
+# contain a delimiter, quote or newline, so no quoting scan is needed
+_OID_UNQUOTED = {16, 20, 21, 23, 26, 700, 701, 1082, 1083, 1114, 1184, 1700}
+
+# text columns with these names may hold data:image payloads and have
+# to go through the Python cell handlers
+_IMAGE_NAME_RE = re.compile(
+    r"image|img|photo|picture|avatar|logo|icon",
+    flags=re.IGNORECASE
+)
+
+# 4-byte magic prefix -> file extension (JPEG is checked separately,
+# its magic is only 3 bytes)
+_MAGIC_EXT = {
+    b"\x89PNG": "png",
+    b"RIFF": "webp",
+}
+
+# flush the row buffer to the file once it grows past this
+_BUF_FLUSH_SIZE = 64 * 1024
+
+# rows per server-side fetch, and how many fetched batches may sit in
+# the producer/consumer queue before the DB reader blocks
+_FETCH_BATCH = 5000
+_QUEUE_DEPTH = 8
+
+# per-text-column cache of encoded cells, sized for enum-like columns
+_TEXT_CACHE_SIZE = 256
+
+
+def _escape_csv(cell: bytes) -> bytes:
+    """Quotes a cell only if it contains a delimiter, quote or newline."""
+    if b'"' in cell or b"," in cell or b"\n" in cell or b"\r" in cell:
+        return b'"' + cell.replace(b'"', b'""') + b'"'
+    return cell
+
+
+def _compile_row_formatter(
+    handlers: List[Callable[[Any], bytes]]
+) -> Callable[[Tuple], bytes]:
+    """
+    exec-builds a formatter specialised to this query's schema: every
+    handler call is inlined by name (no zip, no per-cell indexing in
+    the hot loop). The schema is fixed for the whole query, so the
+    codegen cost is paid once.
+    """
+    if not handlers:
+        return lambda row: b""
+
+    cells = ", ".join(f"_h{i}(row[{i}])" for i in range(len(handlers)))
+    src = f"def _format_row(row):\n    return b','.join(({cells},))\n"
+
+    namespace = {f"_h{i}": h for i, h in enumerate(handlers)}
+    exec(src, namespace)
+    return namespace["_format_row"]
+
+
+def _detect_image_type(img_bytes: bytes) -> Optional[str]:
+    """
+    Returns the file extension for a recognised image magic number,
+    or None if the bytes are not an image. One table lookup replaces
+    the previous startswith chain.
+    """
+    prefix = img_bytes[:4]
+    ext = _MAGIC_EXT.get(prefix)
+    if ext is not None:
+        return ext
+    if prefix[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    return None
+
+
+def _save_image(img_bytes: bytes, column_name: str, ext: str) -> str:
+    filename = f"{column_name}_{uuid.uuid4().hex}.{ext}"
+    path = Path("images") / filename
+
+    # raw fd write: one open/write/close, no buffered file-object
+    # layer for a payload that is written exactly once
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, img_bytes)
+    finally:
+        os.close(fd)
+
+    return str(path)
+
+
+def _make_bytea_handler(column_name: str) -> Callable[[Any], bytes]:
+    def handler(value: Any) -> bytes:
+        if value is None:
+            return b""
+        img_bytes = bytes(value)
+        ext = _detect_image_type(img_bytes)
+        if ext is not None:
+            path = _save_image(img_bytes, column_name, ext)
+            return _escape_csv(path.encode("utf-8"))
+        # hex never needs quoting
+        return img_bytes.hex().encode("ascii")
+
+    return handler
+
+
+def _make_text_handler(column_name: str) -> Callable[[Any], bytes]:
+    # Low-cardinality columns (status flags, categories, country
+    # codes) repeat the same few strings endlessly; cache their
+    # encoded+quoted form so repeats cost one dict lookup. The cap
+    # keeps high-cardinality columns from growing the dict forever.
+    cache: dict = {}
+
+    def handler(value: Any) -> bytes:
+        if value is None:
+            return b""
+        cached = cache.get(value)
+        if cached is not None:
+            return cached
+        # constant-length slice compare is the cheapest possible
+        # pre-filter for the overwhelmingly common plain-text case
+        if value[:11] == "data:image/":
+            comma = value.find(",")
+            if comma > 0:
+                try:
+                    img_bytes = pybase64.b64decode(
+                        value[comma + 1:], validate=True
+                    )
+                    ext = _detect_image_type(img_bytes)
+                    if ext is not None:
+                        path = _save_image(img_bytes, column_name, ext)
+                        return _escape_csv(path.encode("utf-8"))
+                except binascii.Error:
+                    pass
+        encoded = _escape_csv(value.encode("utf-8"))
+        if len(cache) < _TEXT_CACHE_SIZE:
+            cache[value] = encoded
+        return encoded
+
+    return handler
+
+
+def _build_handlers(schema: List[Tuple[str, int]]) -> List[Callable[[Any], bytes]]:
+    """
+    Builds one formatting callable per (column name, type OID) pair,
+    chosen once per query, so the row loop does no per-cell isinstance
+    dispatch or column-name lookups. Handlers return CSV-ready UTF-8
+    bytes, quoted where the content requires it.
+    """
+    handlers = []
+
+    for name, type_code in schema:
+        if type_code == _OID_BYTEA:
+            handlers.append(_make_bytea_handler(name))
+        elif type_code in _OID_TEXT:
+            handlers.append(_make_text_handler(name))
+        elif type_code in _OID_UNQUOTED:
+            handlers.append(
+                lambda v: b"" if v is None else str(v).encode("ascii")
+            )
+        else:
+            # arrays, json, intervals, ... may render with
+            # delimiters, so keep the quoting scan
+            handlers.append(
+                lambda v: b"" if v is None
+                else _escape_csv(str(v).encode("utf-8"))
+            )
+
+    return handlers
+
+
+# ---- multiprocessing workers for image-heavy exports ----
+
+# set once per worker process by _init_format_worker
+_worker_format_row: Optional[Callable[[Tuple], bytes]] = None
+
+
+def _init_format_worker(schema: List[Tuple[str, int]]) -> None:
+    """Pool initializer: compile this query's row formatter once."""
+    global _worker_format_row
+    os.makedirs("images", exist_ok=True)
+    _worker_format_row = _compile_row_formatter(_build_handlers(schema))
+
+
+def _format_batch(batch: List[Tuple]) -> bytes:
+    out = bytearray()
+    for row in batch:
+        out += _worker_format_row(row)
+        out += b"\r\n"
+    return bytes(out)
+
 class DataProcessor:
     def __init__(self, connection: PostgreSQLConnection) -> None:
         self.connection = connection
+        # one persistent connection per worker thread, reused across
+        # rows so each export doesn't pay a fresh TCP + auth handshake
+        self._local = threading.local()
+        self._conns: List = []
+        self._conns_lock = threading.Lock()
         os.makedirs("images", exist_ok=True)
         os.makedirs("output", exist_ok=True)
 
-    def fetch_data(self, query: str) -> Tuple[List[Tuple], List[str]]:
-        with self.connection.connect() as conn:
-            with conn.cursor() as cur:
-                cur.execute(query)
-                return cur.fetchall(), [col[0] for col in cur.description]
-
-    def export_to_csv(self, csv_name: str, columns: List[str], rows: List[Tuple]) -> None:
+    def _get_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.closed:
+            conn = self.connection.connect()
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def close_connections(self) -> None:
+        with self._conns_lock:
+            for conn in self._conns:
+                if not conn.closed:
+                    conn.close()
+            self._conns.clear()
+
+    def export_query_to_csv(self, csv_name: str, query: str) -> None:
         csv_path = Path("output") / f"{csv_name}.csv"
+        query = query.strip().rstrip(";")
 
-        with open(csv_path, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(columns)
+        conn = self._get_connection()
 
-            for row in rows:
-                writer.writerow([
-                    self.process_cell(value, columns[idx])
-                    for idx, value in enumerate(row)
-                ])
+        # "with conn" commits or rolls back the transaction but leaves
+        # the connection open for the next row; a broken connection is
+        # replaced on the next _get_connection call
+        with conn:
+            description = self._describe_query(conn, query)
+
+            if self._has_image_columns(description):
+                self._stream_to_csv_pooled(conn, query, csv_path, description)
+            elif self._needs_cell_processing(description):
+                self._stream_to_csv(conn, query, csv_path, description)
+            else:
+                self._copy_to_csv(conn, query, csv_path, description)
 
         print(f"✅ CSV created: {csv_path}")
 
-    def extract_table_names(self, query: str) -> str:
-        tables = re.findall(
-            r"(?:FROM|JOIN)\s+([a-zA-Z0-9_.\"]+)",
-            query,
-            flags=re.IGNORECASE
+    def _describe_query(self, conn, query: str):
+        """Fetches column metadata via a LIMIT 0 probe, without rows."""
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT * FROM ({query}) AS _probe LIMIT 0")
+            return cur.description
+
+    def _has_image_columns(self, description) -> bool:
+        """True when a column may hold images Python has to extract."""
+        return any(
+            (col.type_code == _OID_BYTEA or col.type_code in _OID_TEXT)
+            and _IMAGE_NAME_RE.search(col.name)
+            for col in description
         )
 
-        clean_tables = {
-            t.replace('"', "").split(".")[-1]
-            for t in tables
-        }
-
-        if not clean_tables:
-            return "result"
-
-        return "_".join(sorted(clean_tables))
-
-    def process_cell(self, value: Any, column_name: str) -> str:
-        if value is None:
-            return ""
-
-        if isinstance(value, (bytes, bytearray)):
-            if self._is_real_image(value):
-                return self._save_image(value, column_name)
-            return value.hex()
-
-        if isinstance(value, str) and value.startswith("data:image"):
-            try:
-                img_bytes = base64.b64decode(value.split(",", 1)[1])
-                if self._is_real_image(img_bytes):
-                    return self._save_image(img_bytes, column_name)
-            except Exception:
-                pass
-
-        return str(value)
-
-    def _is_real_image(self, img_bytes: bytes) -> bool:
-        return (
-            img_bytes.startswith(b"\x89PNG") or
-            img_bytes.startswith(b"\xff\xd8\xff") or
-            img_bytes.startswith(b"RIFF")
+    def _needs_cell_processing(self, description) -> bool:
+        if any(col.type_code == _OID_BYTEA for col in description):
+            # hex-encoding bytea server-side needs an unambiguous
+            # projection, so duplicate column names force the Python path
+            names = [col.name for col in description]
+            return len(set(names)) != len(names)
+
+        return False
+
+    def _copy_to_csv(self, conn, query: str, csv_path: Path,
+                     description) -> None:
+        """
+        Lets Postgres format the CSV itself via COPY ... TO STDOUT and
+        just pipes the bytes to disk — no per-cell Python work at all.
+        Non-image bytea columns are hex-encoded server-side, matching
+        what the Python path's bytes.hex() would produce.
+        """
+        if any(col.type_code == _OID_BYTEA for col in description):
+            select_list = sql.SQL(", ").join(
+                sql.SQL("encode({0}, 'hex') AS {0}").format(
+                    sql.Identifier(col.name)
+                )
+                if col.type_code == _OID_BYTEA
+                else sql.Identifier(col.name)
+                for col in description
+            )
+            source = sql.SQL("SELECT {} FROM ({}) AS _q").format(
+                select_list, sql.SQL(query)
+            )
+        else:
+            source = sql.SQL(query)
+
+        with conn.cursor() as cur:
+            with open(csv_path, "wb", buffering=1 << 20) as f:
+                cur.copy_expert(
+                    sql.SQL(
+                        "COPY ({}) TO STDOUT WITH (FORMAT CSV, HEADER)"
+                    ).format(source),
+                    f,
+                )
+
+    def _stream_to_csv(self, conn, query: str, csv_path: Path,
+                       description) -> None:
+        columns = [col.name for col in description]
+        format_row = _compile_row_formatter(
+            _build_handlers([(col.name, col.type_code) for col in description])
         )
 
-    def _get_image_extension(self, img_bytes: bytes) -> str:
-        if img_bytes.startswith(b"\x89PNG"):
-            return "png"
-        if img_bytes.startswith(b"\xff\xd8\xff"):
-            return "jpg"
-        if img_bytes.startswith(b"RIFF"):
-            return "webp"
-        return "bin"
+        # Named cursor = server-side cursor: rows arrive in batches of
+        # itersize instead of one big fetchall(), so memory stays flat
+        # no matter how large the result set is.
+        with conn.cursor(name=f"exp_{uuid.uuid4().hex}") as cur:
+            cur.itersize = _FETCH_BATCH
+            cur.execute(query)
+
+            # Producer thread pulls batches from the cursor while this
+            # thread formats and writes the previous one — psycopg2
+            # releases the GIL inside libpq, so the network wait
+            # overlaps with cell processing and disk writes.
+            batches: queue.Queue = queue.Queue(maxsize=_QUEUE_DEPTH)
+
+            def produce() -> None:
+                try:
+                    while True:
+                        rows = cur.fetchmany(_FETCH_BATCH)
+                        if not rows:
+                            batches.put(None)
+                            return
+                        batches.put(rows)
+                except Exception as exc:
+                    batches.put(exc)
+
+            producer = threading.Thread(target=produce, daemon=True)
+            producer.start()
+
+            # Binary file + 1 MiB buffer: handlers emit UTF-8 bytes
+            # directly, so rows are joined and written without the
+            # TextIO encode layer or csv.writer's per-cell dispatch.
+            with open(csv_path, "wb", buffering=1 << 20) as f:
+                buf = bytearray()
+                buf += b",".join(
+                    _escape_csv(col.encode("utf-8")) for col in columns
+                )
+                buf += b"\r\n"
+
+                while True:
+                    batch = batches.get()
+                    if batch is None:
+                        break
+                    if isinstance(batch, Exception):
+                        raise batch
+
+                    for row in batch:
+                        buf += format_row(row)
+                        buf += b"\r\n"
+                        if len(buf) > _BUF_FLUSH_SIZE:
+                            f.write(buf)
+                            buf.clear()
+
+                f.write(buf)
+
+            producer.join()
+
+    def _stream_to_csv_pooled(self, conn, query: str, csv_path: Path,
+                              description) -> None:
+        """
+        Variant of _stream_to_csv for image-carrying schemas: base64
+        decode, magic sniffing and image writes are CPU-bound, so row
+        batches are formatted by a process pool while this thread keeps
+        draining the cursor and writing results in order.
+        """
+        schema = [(col.name, col.type_code) for col in description]
+        has_bytea = any(tc == _OID_BYTEA for _, tc in schema)
+        workers = os.cpu_count() or 1
+
+        with conn.cursor(name=f"exp_{uuid.uuid4().hex}") as cur:
+            cur.itersize = _FETCH_BATCH
+            cur.execute(query)
+
+            with multiprocessing.Pool(
+                processes=workers,
+                initializer=_init_format_worker,
+                initargs=(schema,),
+            ) as pool:
+                with open(csv_path, "wb", buffering=1 << 20) as f:
+                    header = b",".join(
+                        _escape_csv(name.encode("utf-8")) for name, _ in schema
+                    )
+                    f.write(header + b"\r\n")
+
+                    # bounded window of batches in flight: cursor reads
+                    # overlap worker compute without ever buffering the
+                    # whole result set
+                    pending: deque = deque()
+
+                    while True:
+                        rows = cur.fetchmany(_FETCH_BATCH)
+                        if not rows:
+                            break
+                        if has_bytea:
+                            # memoryview cells don't pickle
+                            rows = [
+                                tuple(
+                                    bytes(c) if isinstance(c, memoryview) else c
+                                    for c in row
+                                )
+                                for row in rows
+                            ]
+                        pending.append(pool.apply_async(_format_batch, (rows,)))
+                        if len(pending) >= workers * 2:
+                            f.write(pending.popleft().get())
+
+                    while pending:
+                        f.write(pending.popleft().get())
 
-    def _save_image(self, img_bytes: bytes, column_name: str) -> str:
-        ext = self._get_image_extension(img_bytes)
-        filename = f"{column_name}_{uuid.uuid4().hex}.{ext}"
-        path = Path("images") / filename
+    def extract_table_names(self, query: str) -> str:
+        def _norm(t: str) -> str:
+            dot = t.rfind(".")
+            tail = t if dot < 0 else t[dot + 1:]
+            return tail.replace('"', "")
+
+        # dict.fromkeys dedups in one pass without the set+sort
+        # double walk
+        names = "_".join(
+            sorted(dict.fromkeys(map(_norm, _TABLE_RE.findall(query))))
+        )
 
-        with open(path, "wb") as f:
-            f.write(img_bytes)
+        if not names:
+            return "result"
 
-        return str(path)
+        return names
 
 
 # ================= Excel Helper =================
@@ -165,6 +513,33 @@ def get_unique_csv_name(base_name: str) -> str:
 
 # ================= MAIN =================
 
+# each export gets its own connection, so cap how many run at once
+MAX_WORKERS = 8
+
+# crash-recovery sidecar: statuses land here after every finished row,
+# the workbook itself is only saved once at the end
+STATUS_FILE = Path(".status.json")
+
+def load_status_sidecar() -> dict:
+    try:
+        with open(STATUS_FILE, encoding="utf-8") as f:
+            return {int(row): status for row, status in json.load(f).items()}
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_status_sidecar(statuses: dict) -> None:
+    tmp = STATUS_FILE.with_name(STATUS_FILE.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(statuses, f)
+    os.replace(tmp, STATUS_FILE)
+
+def export_row(processor: DataProcessor, csv_name: str, query: str) -> str:
+    try:
+        processor.export_query_to_csv(csv_name, query)
+        return "Done"
+    except Exception as e:
+        return f"ERROR: {str(e)}"
+
 def main():
     postgres = PostgreSQLConnection()
     processor = DataProcessor(postgres)
@@ -172,39 +547,64 @@ def main():
     excel_file = get_excel_file()
     print(f"📄 Using Excel file: {excel_file.name}")
 
-    wb = load_workbook(excel_file)
+    # read_only streams rows instead of building the whole cell graph
+    # in memory; new statuses are collected in a dict and written back
+    # in a single normal-mode pass at the end.
+    wb = load_workbook(excel_file, read_only=True, data_only=True)
     sheet = wb.active
 
-    for row in range(2, sheet.max_row + 1):
-        query = sheet[f"C{row}"].value
-        csv_name_cell = sheet[f"D{row}"]   # CSV Name
-        status_cell = sheet[f"E{row}"]     # Status
+    # statuses left over from a crashed run count as processed and are
+    # reconciled into the workbook at the end
+    statuses = load_status_sidecar()
+
+    # Queries are independent round trips to Postgres, so run them
+    # concurrently: one export's network wait overlaps with another's
+    # CSV writing. Statuses are only touched from this thread.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = {}
+
+        for row, values in enumerate(
+            sheet.iter_rows(min_row=2, values_only=True), start=2
+        ):
+            query = values[2] if len(values) > 2 else None     # C: Query
+            csv_name = values[3] if len(values) > 3 else None  # D: CSV Name
+            status = values[4] if len(values) > 4 else None    # E: Status
+
+
+            if not query:
+                continue
+
+            if not csv_name:
+                statuses[row] = "ERROR: CSV name missing"
+                continue
 
+            if status or row in statuses:
+                continue   # already processed
 
-        if not query:
-            continue
 
-        if not csv_name_cell.value:
-            status_cell.value = "ERROR: CSV name missing"
-            continue
+            csv_name = csv_name.replace(".csv", "").strip()
 
-        if status_cell.value:
-            continue   # already processed
 
+            print(f"▶ Processing row {row}: {csv_name}")
 
-        csv_name = csv_name_cell.value.replace(".csv", "").strip()
+            future = pool.submit(export_row, processor, csv_name, query)
+            futures[future] = row
 
+        for future in as_completed(futures):
+            statuses[futures[future]] = future.result()
+            save_status_sidecar(statuses)
 
-        print(f"▶ Processing row {row}: {csv_name}")
+    processor.close_connections()
+    wb.close()
 
-        try:
-            data, columns = processor.fetch_data(query)
-            processor.export_to_csv(csv_name, columns, data)
-            status_cell.value = "Done"
-        except Exception as e:
-            status_cell.value = f"ERROR: {str(e)}"
+    if statuses:
+        wb = load_workbook(excel_file)
+        sheet = wb.active
+        for row, status in statuses.items():
+            sheet[f"E{row}"] = status
+        wb.save(excel_file)
 
-    wb.save(excel_file)
+    STATUS_FILE.unlink(missing_ok=True)
     print("🎯 Excel updated successfully")
 
 